@@ -1,43 +1,75 @@
-#! /usr/bin/env python2
+#! /usr/bin/python3 -IS
 #
 # __ssmuse.py
+#
+# Run isolated and without site-packages to keep startup cheap; the
+# heavier modules (logging, subprocess, tempfile) are imported only
+# where needed.
 
 import os
-from os.path import basename, dirname, exists, isdir, realpath
+from os.path import basename, dirname
 from os.path import join as joinpath
-import socket
-import subprocess
 import sys
-import tempfile
 import time
 
+class ProbeTimeout(Exception):
+    pass
+
 class CodeGenerator:
 
+    # lazy loading (command stubs) available
+    lazy = False
+
     def __init__(self):
         self.segs = []
+        # (name, pend, paths) of generated path updates
+        self.pathops = []
+        # (path, contributions or None if unloaded) of loads
+        self.loads = []
+        self.loadedvalue = os.environ.get("SSMUSE_LOADED", "")
+        # profile scripts sourced since the last rerun point
+        self.sourced = False
 
     def __str__(self):
         return "".join(self.segs)
 
+    def hasrerunpoint(self, args):
+        """Return True if ssmuseonchangeddeps(args) emits a point at
+        which the remaining args may be rerun: only profile scripts
+        can change the depnames.
+        """
+        return bool(args) and self.sourced
+
     def log(self, mtype, text):
         if verbose:
             self.echo2err("[%s] [%s] %s" % (selfpid, mtype, text))
 
 class CshCodeGenerator(CodeGenerator):
     """Code generator for csh-family of shells.
+
+    Each statement is kept to a single line so that the whole of the
+    code can be joined into one line and passed to eval (csh
+    command substitution does not preserve newlines). Platform blocks
+    are the exception; they are never eval'ed.
     """
 
     def __init__(self):
         CodeGenerator.__init__(self)
 
+    def __str__(self):
+        if not oneline:
+            return CodeGenerator.__str__(self)
+        return "; ".join([seg.rstrip("\n") for seg in self.segs])
+
     def comment(self, s):
-        self.segs.append("# %s\n" % (s,))
+        if not oneline:
+            self.segs.append("# %s\n" % (s,))
 
-    def deduppath(self, name):
-        self.segs.append("""
-if ( $?%s == 1 ) then
-    setenv %s "`%s/ssmuse_cleanpath ${%s}`"
-endif\n""" % (name, name, heredir, name))
+    def deduppath(self, name, drops=None, inserts=None):
+        # defer substitution until the variable is known to be set;
+        # "-" stands for an empty list
+        self.segs.append("""if ( $?%s ) eval 'setenv %s "`%s/ssmuse_cleanpath ${%s} %s %s`"'\n""" \
+            % (name, name, heredir, name, ":".join(drops or ["-"]), ":".join(inserts or ["-"])))
 
     def echo2err(self, s):
         pass
@@ -49,34 +81,48 @@ endif\n""" % (name, name, heredir, name))
         self.segs.append("%s\n" % (s,))
 
     def exportpath(self, name, val, fallback):
-        self.segs.append("""
-if ( $?%s == 0 ) then
-    setenv %s "%s"
-else
-    if ( "${%s}" != "" ) then
-        setenv %s "%s"
-    else
-        setenv %s "%s"
-    endif
-endif\n""" % (name, name, fallback, name, name, val, name, fallback))
+        # unset and empty are both handled by the fallback
+        self.segs.append("""if ( ! $?%s ) setenv %s ""\n""" % (name, name))
+        self.segs.append("""if ( "${%s}" != "" ) setenv %s "%s"\n""" % (name, name, val))
+        self.segs.append("""if ( "${%s}" == "" ) setenv %s "%s"\n""" % (name, name, fallback))
 
     def exportvar(self, name, val):
         self.segs.append("""setenv %s "%s"\n""" % (name, val))
 
+    def platformblocks(self, blocks):
+        # platforms as found by getplatforms()
+        self.segs.append("""set __ssmuse_platforms = ( )\n""")
+        self.segs.append("""if ( $?SSMUSE_PLATFORMS ) eval 'set __ssmuse_platforms = ( ${SSMUSE_PLATFORMS} )'\n""")
+        self.segs.append("""if ( $#__ssmuse_platforms == 0 && -r /etc/ssm/platforms ) set __ssmuse_platforms = ( `cat /etc/ssm/platforms` )\n""")
+        self.segs.append("""if ( $#__ssmuse_platforms == 0 ) set __ssmuse_platforms = ( `ssmuse_platforms` )\n""")
+        self.segs.append("""set __ssmuse_platform0 = ""\n""")
+        self.segs.append("""if ( $#__ssmuse_platforms > 0 ) set __ssmuse_platform0 = "${__ssmuse_platforms[1]}"\n""")
+        self.segs.append("""unset __ssmuse_matched\n""")
+        for platforms, cg in blocks:
+            self.segs.append("""if ( "${__ssmuse_platform0}" == "%s" ) then\n""" % (platforms[0],))
+            self.segs.append("""set __ssmuse_matched\n""")
+            self.segs.extend(cg.segs)
+            self.segs.append("""endif\n""")
+        self.segs.append("""if ( ! $?__ssmuse_matched ) echo "warning: ssmuse: no code for platform (${__ssmuse_platform0})" > /dev/stderr\n""")
+        self.segs.append("""unset __ssmuse_platforms __ssmuse_platform0 __ssmuse_matched\n""")
+
     def sourcefile(self, path):
         self.segs.append("""source "%s"\n""" % (path,))
+        self.sourced = True
+
+    def hasrerunpoint(self, args):
+        return CodeGenerator.hasrerunpoint(self, args) and oneline
 
     def ssmuseonchangeddeps(self, args):
-        if args:
-            names = ["${%s}" % name for name in depnames]
-            values = [os.environ.get(name, "") for name in depnames]
-            quotedargs = ["'%s'" % arg for arg in args]
-            self.segs.append("""
-if ( "%s" != '%s' ) then
-    source %s %s %s
-    return
-fi
-""" % ("::".join(names), "::".join(values), "ssmuse-sh", verbose and "-v" or "", " ".join(quotedargs)))
+        # eval'ed code cannot return early: once profile scripts (which
+        # may change the depnames) are sourced, the remaining args are
+        # left to ssmuse-csh to run after the eval; older front-ends
+        # (--tmp) do not rerun, so the args are loaded here as before
+        if self.hasrerunpoint(args):
+            quotedargs = ["'%s'" % arg for arg in (verbose and ["-v"] or [])+args]
+            self.segs.append("""set __ssmuse_rerun = ( %s )\n""" % (" ".join(quotedargs),))
+            return True
+        return False
 
     def unexportvar(self, name):
         self.segs.append("""unsetenv %s\n""" % (name,))
@@ -85,17 +131,19 @@ class ShCodeGenerator(CodeGenerator):
     """Code generator for sh-family of shells.
     """
 
+    lazy = True
+
     def __init__(self):
         CodeGenerator.__init__(self)
 
     def comment(self, s):
         self.segs.append("# %s\n" % (s,))
 
-    def deduppath(self, name):
+    def deduppath(self, name, drops=None, inserts=None):
         self.segs.append("""
 if [ -n "${%s}" ]; then
-    export %s="$(%s/ssmuse_cleanpath ${%s})"
-fi\n""" % (name, name, heredir, name))
+    export %s="$(%s/ssmuse_cleanpath ${%s} '%s' '%s')"
+fi\n""" % (name, name, heredir, name, ":".join(drops or []), ":".join(inserts or [])))
 
     def echo2out(self, s):
         self.segs.append("""echo "%s"\n""" % (s,))
@@ -117,11 +165,63 @@ fi\n""" % (name, name, val, name, fallback))
     def exportvar(self, name, val):
         self.segs.append("""export %s="%s"\n""" % (name, val))
 
+    def lazyload(self, opt, path, cmdnames):
+        # bash only (elsewhere, loaded now): one stub function per
+        # command; the first call of any of them loads the owner (opt
+        # path) into the shell; stubs do not replace shell functions
+        # and, if appended, known commands; the bash code is eval'ed so
+        # that other shells need not parse it
+        load = "%s %s" % (opt, path)
+        bashsegs = [SH_LAZY_RUN]
+        for cmdname in cmdnames:
+            stub = """function %s { __ssmuse_lazyrun '%s' %s "$@"; }; __ssmuse_lazyowners[%s]='%s'""" \
+                % (cmdname, load, cmdname, cmdname, load)
+            if opt[0] == "+":
+                stub = """command -v %s > /dev/null || { %s; }""" % (cmdname, stub)
+            else:
+                stub = """{ ! declare -F %s > /dev/null || [ -n "${__ssmuse_lazyowners[%s]}" ]; } && { %s; }""" \
+                    % (cmdname, cmdname, stub)
+            bashsegs.append("%s\n" % (stub,))
+        self.segs.append("""
+if [ -n "${BASH_VERSION}" ]; then
+    eval '%s'
+else
+    eval "$(__ssmuse sh --eval %s)"
+fi\n""" % ("".join(bashsegs).replace("'", "'\\''"), load))
+
+    def platformblocks(self, blocks):
+        # platforms as found by getplatforms()
+        self.segs.append("""
+__ssmuse_platform0="${SSMUSE_PLATFORMS%% *}"
+if [ -z "${SSMUSE_PLATFORMS}" ]; then
+    if [ -r /etc/ssm/platforms ]; then
+        __ssmuse_platform0="$(cat /etc/ssm/platforms)"
+    else
+        __ssmuse_platform0="$(ssmuse_platforms)"
+    fi
+    __ssmuse_platform0="$(echo ${__ssmuse_platform0})"
+    __ssmuse_platform0="${__ssmuse_platform0%% *}"
+fi
+__ssmuse_matched=""\n""")
+        for platforms, cg in blocks:
+            self.segs.append("""
+if [ "${__ssmuse_platform0}" = "%s" ]; then
+__ssmuse_matched=1\n""" % (platforms[0],))
+            self.segs.extend(cg.segs)
+            self.segs.append("""fi\n""")
+        self.segs.append("""
+if [ -z "${__ssmuse_matched}" ]; then
+    echo "warning: ssmuse: no code for platform (${__ssmuse_platform0})" 1>&2
+fi
+unset __ssmuse_platform0 __ssmuse_matched\n""")
+
     def sourcefile(self, path):
         self.segs.append(""". "%s"\n""" % (path,))
+        self.sourced = True
 
     def ssmuseonchangeddeps(self, args):
-        if args:
+        if self.hasrerunpoint(args):
+            self.sourced = False
             names = ["${%s}" % name for name in depnames]
             values = [os.environ.get(name, "") for name in depnames]
             quotedargs = ["'%s'" % arg for arg in args]
@@ -135,22 +235,131 @@ fi
     def unexportvar(self, name):
         self.segs.append("""unset %s\n""" % (name,))
 
+# stubs run in the current shell: the owner is loaded into it, the
+# stubs of the owner are removed, and the command is run from PATH;
+# later calls are native
+SH_LAZY_RUN = """
+if ! declare -F __ssmuse_lazyrun > /dev/null; then
+    declare -gA __ssmuse_lazyowners
+    function __ssmuse_lazyrun {
+        typeset load name code
+
+        load="$1"
+        shift 1
+        for name in "${!__ssmuse_lazyowners[@]}"; do
+            if [ "${__ssmuse_lazyowners[${name}]}" = "${load}" ]; then
+                unset -f "${name}"
+                unset "__ssmuse_lazyowners[${name}]"
+            fi
+        done
+        if code="$(__ssmuse sh --eval ${load})"; then
+            __ssmuse_lazyeval "${code}"
+        fi
+        command "$@"
+    }
+    function __ssmuse_lazyeval {
+        eval "$1"
+    }
+fi
+"""
+
+# names which cannot be, or must not be shadowed by, stubs
+SH_RESERVED = set("""! [[ ]] { } case do done elif else esac fi for function
+    if in select then time until while . : [ alias bg bind break builtin
+    caller cd command compgen complete compopt continue declare dirs
+    disown echo enable eval exec exit export false fc fg getopts hash help
+    history jobs kill let local logout mapfile popd printf pushd pwd read
+    readarray readonly return set shift shopt source suspend test times
+    trap true type typeset ulimit umask unalias unset wait""".split())
+SH_NAMECHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.+-")
+
+class JsonCodeGenerator(CodeGenerator):
+    """Generator of a structured (JSON) list of operations, for tools
+    which write their own code (e.g., job scripts). Profile scripts
+    are those of the sh-family.
+    """
+
+    def __init__(self):
+        CodeGenerator.__init__(self)
+
+    def __str__(self):
+        import json
+
+        return json.dumps(self.segs, indent=1)+"\n"
+
+    def comment(self, s):
+        self.segs.append({"op": "comment", "text": s})
+
+    def deduppath(self, name, drops=None, inserts=None):
+        self.segs.append({"op": "deduppath", "name": name,
+            "drops": drops or [], "inserts": inserts or []})
+
+    def echo2out(self, s):
+        self.segs.append({"op": "echo", "text": s})
+
+    def echo2err(self, s):
+        printe(s)
+
+    def execute(self, s):
+        self.segs.append({"op": "execute", "command": s})
+
+    def exportpath(self, name, val, fallback):
+        self.segs.append({"op": "exportpath", "name": name, "value": val, "fallback": fallback})
+
+    def exportvar(self, name, val):
+        self.segs.append({"op": "exportvar", "name": name, "value": val})
+
+    def platformblocks(self, blocks):
+        for platforms, cg in blocks:
+            self.segs.append({"op": "platforms", "platforms": platforms, "ops": cg.segs})
+
+    def sourcefile(self, path):
+        self.segs.append({"op": "sourcefile", "path": path})
+        self.sourced = True
+
+    def ssmuseonchangeddeps(self, args):
+        if self.hasrerunpoint(args):
+            self.sourced = False
+            names = sorted(depnames)
+            values = [os.environ.get(name, "") for name in names]
+            self.segs.append({"op": "ssmuseonchangeddeps",
+                "depnames": names, "values": values, "args": args})
+
+    def unexportvar(self, name):
+        self.segs.append({"op": "unexportvar", "name": name})
+
 ##
 ##
 ##
 
+def exists(path):
+    return probe(os.path.exists, path)
+
 def getplatforms():
     platforms = os.environ.get("SSMUSE_PLATFORMS")
     if platforms == None:
-        if exists("/etc/ssm/platforms"):
+        if os.path.exists("/etc/ssm/platforms"):
             platforms = open("/etc/ssm/platforms").read()
         else:
-            p = subprocess.Popen(joinpath(heredir, "ssmuse_platforms"), stdout=subprocess.PIPE)
-            platforms, _ = p.communicate()
-    return filter(None, platforms.split())
+            def senseplatforms():
+                import subprocess
+
+                p = subprocess.Popen(joinpath(heredir, "ssmuse_platforms"), stdout=subprocess.PIPE)
+                platforms, _ = p.communicate()
+                return platforms.decode()
+
+            # sensed platforms change with the OS or the sensing script
+            mtimes = []
+            for path in [joinpath(heredir, "ssmuse_platforms"), "/etc/os-release"]:
+                try:
+                    mtimes.append(str(os.stat(path).st_mtime))
+                except OSError:
+                    mtimes.append("-")
+            platforms = cacheget("platforms:%s" % (hostname,), " ".join(mtimes), senseplatforms)
+    return platforms.split()
 
 def is_dgpath(path):
-    for name in os.listdir(path):
+    for name in listdir(path):
         if is_dompath(joinpath(path, name)):
             return True
     return False
@@ -161,16 +370,19 @@ def is_dompath(path):
 def is_pkgpath(path):
     return exists(joinpath(path, ".ssm.d/control"))
 
+def isdir(path):
+    return probe(os.path.isdir, path)
+
 def isemptydir(path):
     if not isdir(path):
         return True
-    l = os.listdir(path)
+    l = listdir(path)
     return len(l) == 0
 
 def islibfreedir(path):
     if not isdir(path):
         return True
-    l = [name for name in os.listdir(path) if name.endswith(".a") or name.endswith(".so")]
+    l = [name for name in listdir(path) if name.endswith(".a") or name.endswith(".so")]
     return len(l) == 0
 
 def isnotemptydir(path):
@@ -179,9 +391,168 @@ def isnotemptydir(path):
 def isnotlibfreedir(path):
     return not islibfreedir(path)
 
+def listdir(path):
+    return probe(os.listdir, path)
+
 def printe(s):
     sys.stderr.write(s+"\n")
 
+def probe(fn, path):
+    """Memoized filesystem probe (fn(path)), including failures.
+
+    Results are shared by the whole invocation (e.g., by all platform
+    lists of --platforms-set).
+    """
+    key = (fn.__name__, path)
+    try:
+        value = probes[key]
+    except KeyError:
+        if probetimeout:
+            value = timedprobe(fn, path)
+        else:
+            try:
+                value = fn(path)
+            except OSError as e:
+                value = e
+        probes[key] = value
+    if isinstance(value, OSError):
+        raise value
+    return value
+
+# filesystem types which may become unresponsive (network, cluster)
+REMOTE_FSTYPES = ["9p", "afs", "autofs", "beegfs", "ceph", "cifs", "fuse.sshfs",
+    "glusterfs", "gpfs", "lustre", "ncpfs", "nfs", "nfs4", "smb3", "smbfs"]
+
+def getmountroot(path):
+    """Return the mount point under which path is found.
+    """
+    global mountroots
+
+    if mountroots == None:
+        mountroots = []
+        try:
+            for line in open("/proc/self/mounts"):
+                t = line.split()
+                mountroots.append((t[1].replace("\\040", " "), t[2]))
+        except (IOError, IndexError):
+            pass
+        mountroots.sort(key=lambda t: len(t[0]), reverse=True)
+    for root, _ in mountroots:
+        if path == root or path.startswith(root.rstrip("/")+"/"):
+            return root
+    return "/".join(path.split("/")[:3]) or "/"
+
+def isremoteroot(root):
+    """Return True if the mount root may be of a remote filesystem
+    (unknown mounts included), but never for /.
+    """
+    if root == "/":
+        return False
+    for _root, fstype in mountroots or []:
+        if _root == root:
+            return fstype in REMOTE_FSTYPES
+    return True
+
+def timedprobe(fn, path):
+    """Run fn(path) on a worker thread, bounded by the per-probe and
+    total (SSMUSE_PROBE_TIMEOUT) deadlines. Once a probe times out,
+    its mount root, if remote, is considered unresponsive and later
+    probes under it fail immediately. Raises ProbeTimeout; other
+    failures of fn are raised as is.
+    """
+    import threading
+
+    root = getmountroot(path)
+    if root in deadroots:
+        raise ProbeTimeout("unresponsive mount (%s)" % (root,))
+    timeout = min(probetimeout, probedeadline-time.time())
+    if timeout <= 0:
+        raise ProbeTimeout("probe time exhausted (%s)" % (path,))
+
+    result = []
+    def run():
+        # any failure is passed on to the caller
+        try:
+            result.append(fn(path))
+        except Exception as e:
+            result.append(e)
+
+    th = threading.Thread(target=run)
+    th.daemon = True
+    th.start()
+    th.join(timeout)
+    if not result:
+        # a slow local filesystem is not given up on
+        if isremoteroot(root):
+            deadroots.add(root)
+        raise ProbeTimeout("probe timed out (%s) under mount (%s)" % (path, root))
+    if isinstance(result[0], Exception) and not isinstance(result[0], OSError):
+        raise result[0]
+    return result[0]
+
+def matchversion(version, constraints):
+    """Return True if version satisfies all of the (op, version)
+    constraints.
+    """
+    key = versionkey(version)
+    for op, cversion in constraints:
+        ckey = versionkey(cversion)
+        if op in ["=", "=="]:
+            ok = key == ckey
+        elif op == "!=":
+            ok = key != ckey
+        elif op == ">=":
+            ok = key >= ckey
+        elif op == "<=":
+            ok = key <= ckey
+        elif op == ">":
+            ok = key > ckey
+        elif op == "<":
+            ok = key < ckey
+        else:
+            ok = False
+        if not ok:
+            return False
+    return True
+
+def readfile(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def realpath(path):
+    return probe(os.path.realpath, path)
+
+def splitpkgspec(spec):
+    """Split a package spec (e.g., foo>=1.2,<2) into name and list of
+    (op, version) constraints.
+    """
+    for i, c in enumerate(spec):
+        if c in "<>=!":
+            break
+    else:
+        return spec, []
+    constraints = []
+    for s in spec[i:].split(","):
+        j = len(s)-len(s.lstrip("<>=!"))
+        constraints.append((s[:j], s[j:]))
+    return spec[:i], constraints
+
+def versionkey(version):
+    """Return sort key for version: numeric fields compare as numbers
+    and after non-numeric ones (e.g., 1.10 > 1.9 > 1.rc1); the end of
+    a version is between the two, so a release comes after its
+    pre-releases and before its updates (e.g., 2.0.1 > 2.0 >
+    2.0-beta).
+    """
+    key = []
+    for field in version.replace("-", ".").split("."):
+        if field.isdigit():
+            key.append((2, int(field), ""))
+        else:
+            key.append((0, 0, field))
+    key.append((1, 0, ""))
+    return tuple(key)
+
 VARS_SETUPTABLE = [
     # envvars, basenames, XDIR envvar, testfn
     (["PATH"], ["/bin"], None, None),
@@ -204,7 +575,9 @@ def __exportpendpath(pend, name, path):
         val = "%s:${%s}" % (path, name)
     elif pend == "append":
         val = "${%s}:%s" % (name, path)
-    cg.exportpath(name, val, path)
+    if not deferpaths:
+        cg.exportpath(name, val, path)
+    cg.pathops.append((name, pend, [path]))
 
 def __exportpendmpaths(pend, name, paths):
     """No checks.
@@ -215,7 +588,38 @@ def __exportpendmpaths(pend, name, paths):
             val = "%s:${%s}" % (jpaths, name)
         elif pend == "append":
             val = "${%s}:%s" % (name, jpaths)
-        cg.exportpath(name, val, jpaths)
+        if not deferpaths:
+            cg.exportpath(name, val, jpaths)
+        cg.pathops.append((name, pend, list(paths)))
+
+def __replacepaths(name, drops, inserts):
+    """No checks. Remove drops and put inserts at the position of the
+    first of drops (prepend if not found).
+    """
+    if drops:
+        cg.deduppath(name, drops, inserts)
+        cg.pathops.append((name, "replace", (drops, inserts)))
+    elif inserts:
+        __exportpendmpaths("prepend", name, inserts)
+
+def applypathops(envpaths, pathops):
+    """Apply path updates to envpaths (name -> list), in place.
+    """
+    for name, pend, paths in pathops:
+        l = envpaths.get(name, [])
+        if pend == "prepend":
+            l = paths+l
+        elif pend == "append":
+            l = l+paths
+        elif pend == "replace":
+            drops, inserts = paths
+            for i, path in enumerate(l):
+                if path in drops:
+                    break
+            else:
+                i = 0
+            l = l[:i]+inserts+[path for path in l[i:] if path not in drops]
+        envpaths[name] = l
 
 def augmentssmpath(pathtype, path):
     if path.startswith("/") \
@@ -223,24 +627,20 @@ def augmentssmpath(pathtype, path):
         or path.startswith("../"):
         paths = [path]
     else:
-        if "SSMUSE_PATH" in os.environ:
-            basedirs = os.environ["SSMUSE_PATH"].split(":")
-        elif "SSMUSE_BASE" in os.environ:
-            basedirs = [os.environ["SSMUSE_BASE"]]
-        elif "SSM_DOMAIN_BASE" in os.environ:
-            basedirs = [os.environ["SSM_DOMAIN_BASE"]]
-        else:
-            basedirs = []
-        paths = [os.path.join(basedir, path) for basedir in basedirs]
+        paths = [os.path.join(basedir, path) for basedir in getbasedirs()]
 
+    sensed = pathtype == None
     for path in paths:
         path = realpath(path)
         if pathtype == None:
-            pkgpath = matchpkgpath(path)
+            # not by name: that lists the directory
+            pkgpath = matchpkgpath(path, False)
 
             # note: keep the following order
             if pkgpath != None:
                 pathtype = "package"
+            elif not exists(path):
+                path = None
             elif is_dompath(path):
                 pathtype = "domain"
             elif is_dgpath(path):
@@ -265,12 +665,162 @@ def augmentssmpath(pathtype, path):
 
         if path != None:
             break
+
+    if sensed and path == None:
+        # package by name (e.g., foo, foo>=1.2) only if nothing else
+        # matched
+        for _path in paths:
+            _path = realpath(_path)
+            if matchpkgpath(_path) != None:
+                pathtype, path = "package", _path
+                break
     return pathtype, path
 
+def cacheget(key, token, buildfn):
+    """Return the cached value (a string) for key, built by buildfn.
+
+    An entry is valid only if it was stored with the same token (e.g.,
+    a path or an mtime). The token may also be a function of the
+    value, for entries which record what they were built from. Across processes, only one rebuilds a
+    given key (exclusive lock on a per-key lock file) while the
+    others use a stale entry, if any, or wait up to cachewait seconds
+    for the rebuild to finish. Entries are written to a temp file and
+    renamed into place so readers never see partial entries.
+
+    Without SSMUSE_CACHE, buildfn is simply called.
+    """
+    if not cachedir:
+        return buildfn()
+
+    def readentry():
+        try:
+            with open(path) as f:
+                etoken, value = f.read().split("\n", 1)
+            return etoken, value
+        except (IOError, OSError, ValueError):
+            return None, None
+
+    def gettoken(value):
+        if callable(token):
+            return str(token(value))
+        return str(token)
+
+    path = joinpath(cachedir, key.replace("%", "%25").replace("/", "%2F"))
+    etoken, value = readentry()
+    if etoken != None and etoken == gettoken(value):
+        return value
+
+    import fcntl
+
+    try:
+        lockfd = os.open(path+".lock", os.O_RDWR|os.O_CREAT, 0o666)
+    except OSError:
+        cg.log("warning", "cacheget: cannot open lock for key (%s)" % (key,))
+        return buildfn()
+
+    try:
+        deadline = time.time()+cachewait
+        while True:
+            try:
+                fcntl.flock(lockfd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                if value != None:
+                    # someone else is rebuilding; stale is good enough
+                    cg.log("info", "cacheget: using stale entry for key (%s)" % (key,))
+                    return value
+                if time.time() > deadline:
+                    cg.log("warning", "cacheget: timed out waiting for key (%s)" % (key,))
+                    return buildfn()
+                time.sleep(0.05)
+
+        # may have been rebuilt while waiting for the lock
+        etoken, value = readentry()
+        if etoken != None and etoken == gettoken(value):
+            return value
+
+        value = buildfn()
+        tmppath = "%s.%s" % (path, selfpid)
+        try:
+            with open(tmppath, "w") as f:
+                f.write("%s\n%s" % (gettoken(value), value))
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            cg.log("warning", "cacheget: cannot write entry for key (%s)" % (key,))
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+        return value
+    finally:
+        # closing releases the lock
+        os.close(lockfd)
+
+def commentheader():
+    cg.comment("host (%s)" % (hostname,))
+    cg.comment("date (%s)" % (time.asctime(),))
+    cg.comment("platforms (%s)" % (" ".join(platforms),))
+    cg.comment("depnames (%s)" % (" ".join(depnames),))
+    for name in ["SSMUSE_BASE", "SSMUSE_CACHE", "SSMUSE_DGROUPNAMES", "SSMUSE_LOG",
+        "SSMUSE_ENV_BUDGET", "SSMUSE_PATH", "SSMUSE_PLATFORMS", "SSMUSE_PROBE_TIMEOUT",
+        "SSMUSE_PRUNE", "SSMUSE_XINCDIRS", "SSMUSE_XLIBDIRS"]:
+        value = os.environ.get(name, "-").replace("\n\t", "  ")
+        cg.comment("env (%s) (%s)" % (name, value))
+
+def compactenvpaths(envpaths):
+    """Drop entries, of absolute paths, which do not exist from
+    envpaths (in place). Entries which cannot be probed in time (or
+    are under a mount root found to be unresponsive) are dropped when
+    pruning (SSMUSE_PRUNE), and kept otherwise. Return name ->
+    dropped entries.
+
+    Without SSMUSE_PROBE_TIMEOUT, the probes of this pass (only) are
+    bounded by 1s; paths probed earlier keep their memoized result.
+    """
+    global probetimeout
+
+    _probetimeout = probetimeout
+    if probetimeout == None:
+        # inherited entries may be on dead mounts; never wait long
+        probetimeout = 1.0
+    drops = {}
+    try:
+        for name in VARS:
+            paths = []
+            for path in envpaths[name]:
+                try:
+                    if path.startswith("/") and not exists(path):
+                        cg.log("info", "compactenvpaths: dropping (%s) (%s)" % (name, path))
+                        drops.setdefault(name, []).append(path)
+                        continue
+                except ProbeTimeout as e:
+                    if prune:
+                        cg.log("info", "compactenvpaths: dropping (%s) (%s): %s" % (name, path, e))
+                        drops.setdefault(name, []).append(path)
+                        continue
+                paths.append(path)
+            envpaths[name] = paths
+    finally:
+        probetimeout = _probetimeout
+    if drops:
+        cg.log("info", "compactenvpaths: dropped (%s) entries" % (sum(map(len, drops.values())),))
+    return drops
+
 def deduppaths():
+    """Collapse duplicates in VARS and, with SSMUSE_ENV_BUDGET or
+    SSMUSE_PRUNE, drop entries which do not exist. The resulting
+    environment size is reported (verbose) and checked against the
+    budget.
+    """
     cg.log("info", "deduppaths:")
+    drops = {}
+    if verbose or envbudget or prune:
+        envpaths = getenvpaths()
+        if envbudget or prune:
+            drops = compactenvpaths(envpaths)
+        reportenvsize(envpaths)
     for name in VARS:
-        cg.deduppath(name)
+        cg.deduppath(name, drops.get(name))
 
 def exportpendlibpath(pend, name, path):
     if isdir(path) and not islibfreedir(path):
@@ -293,7 +843,7 @@ def exportpendpaths(pend, basepath):
     for varnames, basenames, xdirsname, testfn in VARS_SETUPTABLE:
         if xdirsname:
             xdirnames = resolvepcvar(os.environ.get(xdirsname, "")).split(":")
-            xdirnames = filter(None, xdirnames)
+            xdirnames = [name for name in xdirnames if name]
         else:
             xdirnames = []
         for basename in basenames:
@@ -309,6 +859,211 @@ def exportpendpaths(pend, basepath):
         for varname in varnames:
             __exportpendmpaths(pend, varname, paths)
 
+def exportloads():
+    """Export the recorded contributions of loads (SSMUSE_LOADED), if
+    changed.
+
+    Format: <path>;<name>[+...]=<entry>[,...];...[:...] with entries
+    under <path> relative to it; names with the same entries share
+    a field.
+    """
+    records = []
+    for path, contribs in getloadrecords().items():
+        fields = [path]
+        groups = {}
+        for name in VARS:
+            entries = contribs.get(name)
+            if entries:
+                rels = [entry.startswith(path+"/") and entry[len(path)+1:] or entry for entry in entries]
+                rels = ",".join(rels)
+                if rels not in groups:
+                    groups[rels] = []
+                    fields.append(rels)
+                groups[rels].append(name)
+        fields[1:] = ["%s=%s" % ("+".join(groups[rels]), rels) for rels in fields[1:]]
+        records.append(";".join(fields))
+    value = ":".join(records)
+    if value != cg.loadedvalue:
+        cg.exportvar("SSMUSE_LOADED", value)
+        cg.loadedvalue = value
+
+def findload(path):
+    """Return the path and recorded contributions of a load, given as
+    for -x, by (package) name, or as recorded; (None, None) if not
+    found.
+    """
+    records = getloadrecords()
+    _, xpath = sensepath(path)
+    if xpath in records:
+        return xpath, records[xpath]
+    for rpath in reversed(list(records)):
+        name = basename(rpath)
+        if rpath == path or name == path or name.split("_")[0] == path:
+            return rpath, records[rpath]
+    return None, None
+
+def getpkgdeps(pkgpath):
+    """Return the package names listed in the Depends field of the
+    package control file.
+    """
+    try:
+        # other fields may be in any encoding
+        for line in probe(readfile, joinpath(pkgpath, ".ssm.d/control")).split(b"\n"):
+            if line.startswith(b"Depends:"):
+                line = line[8:].decode("utf-8", "replace")
+                names = [name.strip() for name in line.split(",")]
+                return [name for name in names if name]
+    except IOError:
+        pass
+    return []
+
+def getloadrecords():
+    """Return the recorded loads (path -> name -> entries), from
+    SSMUSE_LOADED and the loads of this invocation, oldest first.
+    """
+    records = {}
+    for record in os.environ.get("SSMUSE_LOADED", "").split(":"):
+        fields = record.split(";")
+        if not fields[0].startswith("/"):
+            continue
+        path = fields[0]
+        contribs = {}
+        for field in fields[1:]:
+            names, _, rels = field.partition("=")
+            entries = [joinpath(path, rel) for rel in rels.split(",") if rel]
+            for name in names.split("+"):
+                contribs[name] = entries
+        records[path] = contribs
+    for path, contribs in cg.loads:
+        records.pop(path, None)
+        if contribs != None:
+            records[path] = contribs
+    return records
+
+def getpkgindex(pkgdir):
+    """Return the index of packages in pkgdir: name -> [(version,
+    platform), ...].
+
+    The index is memoized for the invocation and (with SSMUSE_CACHE)
+    on disk; adding or removing a package changes the mtime of
+    pkgdir, so the mtime is sufficient to validate the cached index.
+    """
+    if pkgdir in pkgindexes:
+        return pkgindexes[pkgdir]
+
+    def build():
+        lines = []
+        for name in listdir(pkgdir):
+            t = name.split("_")
+            if len(t) == 3 and "" not in t:
+                lines.append(" ".join(t))
+        lines.sort()
+        return "\n".join(lines)
+
+    try:
+        token = probe(os.stat, pkgdir).st_mtime
+    except OSError:
+        pkgindexes[pkgdir] = {}
+        return {}
+    index = {}
+    for line in cacheget("pkgindex:%s" % (pkgdir,), token, build).split("\n"):
+        if line:
+            name, version, platform = line.split(" ")
+            index.setdefault(name, []).append((version, platform))
+    pkgindexes[pkgdir] = index
+    return index
+
+def getcodegenerator(cgtype):
+    if cgtype == "sh":
+        return ShCodeGenerator()
+    elif cgtype == "csh":
+        return CshCodeGenerator()
+    elif cgtype == "json":
+        return JsonCodeGenerator()
+    return None
+
+def getdgnames():
+    dgnames = resolvepcvar(os.environ.get("SSMUSE_DGROUPNAMES", "")).split(":")
+    return [name for name in dgnames if name]
+
+def getenvpaths():
+    """Return the expected entries (name -> list) of VARS after the
+    path updates generated so far, without duplicates. Changes made
+    by profile scripts are not known.
+    """
+    envpaths = {}
+    for name in VARS:
+        value = os.environ.get(name)
+        envpaths[name] = value and value.split(":") or []
+    applypathops(envpaths, cg.pathops)
+    for name in VARS:
+        seen = set()
+        paths = []
+        for path in envpaths[name]:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+        envpaths[name] = paths
+    return envpaths
+
+def getbasedirs():
+    """Return the base directories searched for relative paths.
+    """
+    if "SSMUSE_PATH" in os.environ:
+        return os.environ["SSMUSE_PATH"].split(":")
+    elif "SSMUSE_BASE" in os.environ:
+        return [os.environ["SSMUSE_BASE"]]
+    elif "SSM_DOMAIN_BASE" in os.environ:
+        return [os.environ["SSM_DOMAIN_BASE"]]
+    return []
+
+def getcmdindex(pathtype, path):
+    """Return the index of commands (name -> domain or package path)
+    found in the bin directories of a domain group, domain, or
+    package; better domains and platforms come first.
+
+    The index is cached (SSMUSE_CACHE) with the mtimes of the bin
+    directories as the token, so unchanged directories are not
+    listed again.
+    """
+    if pathtype == "dgroup":
+        loadpaths = [joinpath(path, dgname) for dgname in getdgnames()]
+        loadpaths = [p for p in loadpaths if is_dompath(p)]
+    else:
+        loadpaths = [path]
+    bindirs = []
+    for loadpath in loadpaths:
+        if pathtype == "package":
+            bindirs.append((loadpath, joinpath(loadpath, "bin")))
+        else:
+            for platform in platforms:
+                bindirs.append((loadpath, joinpath(loadpath, platform, "bin")))
+
+    def build():
+        lines = []
+        seen = set()
+        for loadpath, bindir in bindirs:
+            if isdir(bindir):
+                for name in listdir(bindir):
+                    if name not in seen and len(name.split()) == 1:
+                        seen.add(name)
+                        lines.append("%s %s" % (name, loadpath))
+        return "\n".join(lines)
+
+    mtimes = []
+    for _, bindir in bindirs:
+        try:
+            mtimes.append(str(probe(os.stat, bindir).st_mtime))
+        except OSError:
+            mtimes.append("-")
+    key = "cmdindex:%s:%s" % (" ".join(platforms), path)
+    index = {}
+    for line in cacheget(key, " ".join(mtimes), build).split("\n"):
+        if line:
+            name, loadpath = line.split(" ", 1)
+            index[name] = loadpath
+    return index
+
 def getdepnames():
     depnames = []
     for _, _, xdirsname, _ in VARS_SETUPTABLE:
@@ -321,9 +1076,9 @@ def getdepnames():
                     if len(l) % 2 == 1:
                         names = l[1::2]
                         depnames.extend(names)
-    return set(depnames)
+    return sorted(set(depnames))
 
-def matchpkgpath(pkgpath):
+def matchpkgpath(pkgpath, byname=True):
     pkgname = basename(pkgpath)
     t = pkgname.split("_")
     if len(t) == 2:
@@ -333,6 +1088,9 @@ def matchpkgpath(pkgpath):
             path = joinpath(pkgdir, pkgname+"_"+platform)
             if is_pkgpath(path):
                 return path
+    elif len(t) == 1 and byname and not exists(pkgpath):
+        # bare name or name with version constraints
+        return resolvepkgname(dirname(pkgpath), pkgname)
     elif is_pkgpath(pkgpath):
         return pkgpath
     return None
@@ -347,23 +1105,36 @@ def loaddgroup(pend, dgpath):
 
     # load matching domain group
     loadeddomains = []
-    dgnames = filter(None, resolvepcvar(os.environ.get("SSMUSE_DGROUPNAMES", "")).split(":"))
+    dgnames = getdgnames()
     for dgname in reversed(dgnames):
         dompath = joinpath(dgpath, dgname)
-        if is_dompath(dompath):
-            loaddomain(pend, dompath)
-            loadeddomains.append(dgname)
+        mark = (len(cg.segs), len(logrecords), len(cg.pathops), len(cg.loads), set(loadedpkgpaths))
+        try:
+            if is_dompath(dompath):
+                loaddomain(pend, dompath)
+                loadeddomains.append(dgname)
+        except ProbeTimeout as e:
+            del cg.segs[mark[0]:]
+            del logrecords[mark[1]:]
+            del cg.pathops[mark[2]:]
+            del cg.loads[mark[3]:]
+            loadedpkgpaths.clear()
+            loadedpkgpaths.update(mark[4])
+            cg.log("warning", "loaddgroup: skipping domain (%s): %s" % (dompath, e))
     if not loadeddomains:
         cg.log("warning", "loaddgroup: no domains loaded for dgroup (%s)" % (dgpath,))
 
-def loaddomain(pend, dompath):
+def loaddomain(pend, dompath, t0=None):
     _dompath = dompath
+    if t0 == None:
+        t0 = time.time()
 
     if dompath == None or not isdir(dompath):
         printe("fatal: loaddomain: invalid domain (%s)" % (dompath,))
         sys.exit(1)
 
     cg.log("info", "loaddomain: (%s) (%s)" % (pend, dompath))
+    start = len(cg.pathops)
 
     # load from worse to better platforms
     loadedplatforms = []
@@ -377,15 +1148,18 @@ def loaddomain(pend, dompath):
 
     if not loadedplatforms:
         cg.log("warning", "loaddomain: no platforms loaded for domain (%s)" % (dompath,))
+    recordload(dompath, start)
 
     if logger:
-        log(dompath, "%s|loaddomain|%s|%s|%s|%s|%s|%s|%s|%s|%s" \
+        log(dompath, "%s|loaddomain|%s|%s|%s|%s|%s|%s|%s|%s|%s|%.3f" \
             % (nowst, os.environ.get("LOGNAME"), hostname, platform0,
                 len(loadedplatforms), " ".join(loadedplatforms),
-                shell, pend, _dompath, dompath))
+                shell, pend, _dompath, dompath, time.time()-t0))
 
-def loadpackage(pend, pkgpath):
+def loadpackage(pend, pkgpath, t0=None):
     _pkgpath = pkgpath
+    if t0 == None:
+        t0 = time.time()
 
     if pkgpath == None or not isdir(pkgpath):
         printe("fatal: loadpackage: invalid package (%s)" % (pkgpath,))
@@ -393,28 +1167,74 @@ def loadpackage(pend, pkgpath):
 
     cg.log("info", "loadpackage: (%s) (%s)" % (pend, pkgpath))
 
+    # dependencies first so that the package takes precedence
+    pkgpaths = resolvepkggraph(pkgpath)
+    if pend == "append":
+        pkgpaths = pkgpaths[::-1]
+    elapsed = time.time()-t0
+    for path in pkgpaths:
+        if path == pkgpath:
+            __loadpackage(pend, _pkgpath, path, elapsed)
+        elif path in loadedpkgpaths:
+            cg.log("info", "loadpackage: dependency already loaded (%s)" % (path,))
+        else:
+            cg.log("info", "loadpackage: dependency (%s) (%s)" % (pend, path))
+            __loadpackage(pend, path, path, 0)
+        loadedpkgpaths.add(path)
+
+def __loadpackage(pend, _pkgpath, pkgpath, elapsed):
+    """No checks. elapsed is time already spent (e.g., resolving).
+    """
+    t0 = time.time()
     pkgname = os.path.basename(pkgpath)
+    start = len(cg.pathops)
     exportpendpaths(pend, pkgpath)
+    recordload(pkgpath, start)
     path = joinpath(pkgpath, "etc/profile.d", pkgname+"."+shell)
     if exists(path):
         cg.sourcefile(path)
     if logger:
-        log(pkgpath, "%s|loadpackage|%s|%s|%s|%s|%s|%s|%s" \
+        log(pkgpath, "%s|loadpackage|%s|%s|%s|%s|%s|%s|%s|%.3f" \
             % (nowst, os.environ.get("LOGNAME"), hostname,
-                platform0, shell, pend, _pkgpath, pkgpath))
+                platform0, shell, pend, _pkgpath, pkgpath,
+                elapsed+time.time()-t0))
 
-def loaddirectory(pend, dirpath):
+def loaddirectory(pend, dirpath, t0=None):
     _dirpath = dirpath
+    if t0 == None:
+        t0 = time.time()
 
     if dirpath == None or not isdir(dirpath):
         printe("fatal: loaddirectory: invalid directory (%s)" % (dirpath,))
         sys.exit(1)
 
+    start = len(cg.pathops)
     exportpendpaths(pend, dirpath)
+    recordload(dirpath, start)
     if logger:
-        log(dirpath, "%s|loaddirectory|%s|%s|%s|%s|%s|%s|%s" \
+        log(dirpath, "%s|loaddirectory|%s|%s|%s|%s|%s|%s|%s|%.3f" \
             % (nowst, os.environ.get("LOGNAME"), hostname,
-                platform0, shell, pend, _dirpath, dirpath))
+                platform0, shell, pend, _dirpath, dirpath, time.time()-t0))
+
+def loadlazy(opt, path):
+    """Register domain group, domain, or package (by load option, e.g.,
+    -d) to be loaded on first use of one of its commands, as found in
+    the (cached) command index. A domain group is loaded whole, in
+    order. Return False if lazy loading is not supported by the shell.
+    """
+    if not cg.lazy:
+        cg.log("warning", "loadlazy: not supported for shell (%s); loading now" % (shell,))
+        return False
+    if path == None or not isdir(path):
+        printe("fatal: loadlazy: invalid path (%s)" % (path,))
+        sys.exit(1)
+    cg.log("info", "loadlazy: (%s) (%s)" % (opt, path))
+    pathtype = {"d": "domain", "g": "dgroup", "p": "package"}[opt[1]]
+    cmdnames = [cmdname for cmdname in getcmdindex(pathtype, path)
+        if cmdname not in SH_RESERVED and not cmdname.startswith("-")
+            and set(cmdname).issubset(SH_NAMECHARS)]
+    cg.lazyload(opt, path, cmdnames)
+    return True
 
 def loadprofiles(dompath, platform):
     cg.log("info", "loadprofiles: (%s) (%s)" % (dompath, platform))
@@ -422,13 +1242,131 @@ def loadprofiles(dompath, platform):
     root = joinpath(dompath, platform, "etc/profile.d")
     if exists(root):
         suff = ".%s" % (shell,)
-        names = [name for name in os.listdir(root) if name.endswith(suff)]
+        names = [name for name in listdir(root) if name.endswith(suff)]
         for name in names:
             path = joinpath(root, name)
             if exists(path):
                 cg.sourcefile(path)
 
+def flushlog():
+    """Emit held log records, each with the total invocation time and
+    the invocation (process) id.
+    """
+    if logger:
+        total = time.time()-starttime
+        for message in logrecords:
+            logger.info("%s|%.3f|%s" % (message, total, selfpid))
+    del logrecords[:]
+
+def loadargs(args):
+    """Process load arguments, generating code with cg.
+    """
+    global verbose
+
+    lazy = False
+    while args:
+        _args = args[:]
+        arg = args.pop(0)
+        mark = (len(cg.segs), len(logrecords), len(cg.pathops), len(cg.loads), set(loadedpkgpaths))
+        try:
+            if arg in ["-d", "+d"] and args:
+                pend = arg[0] == "-" and "prepend" or "append"
+                _dompath = args.pop(0)
+                cg.exportvar("SSMUSE_PENDMODE", pend)
+                t0 = time.time()
+                _, dompath = augmentssmpath("domain", _dompath)
+                if not (lazy and loadlazy(arg, dompath)):
+                    loaddomain(pend, dompath, t0)
+                if cg.hasrerunpoint(args):
+                    # for the rerun; otherwise, exported once at the end
+                    exportloads()
+                if cg.ssmuseonchangeddeps(args):
+                    del args[:]
+            elif arg in ["-f", "+f"] and args:
+                pend = arg[0] == "-" and "prepend" or "append"
+                _dirpath = args.pop(0)
+                cg.unexportvar("SSMUSE_PENDMODE")
+                t0 = time.time()
+                _, dirpath = augmentssmpath("directory", _dirpath)
+                loaddirectory(pend, dirpath, t0)
+            elif arg in ["-g", "+g"] and args:
+                pend = args[0] == "-" and "prepend" or "append"
+                _dgpath = args.pop(0)
+                cg.exportvar("SSMUSE_PENDMODE", pend)
+                _, dgpath = augmentssmpath("dgroup", _dgpath)
+                if not (lazy and loadlazy(arg, dgpath)):
+                    loaddgroup(pend, dgpath)
+                if cg.hasrerunpoint(args):
+                    # for the rerun; otherwise, exported once at the end
+                    exportloads()
+                if cg.ssmuseonchangeddeps(args):
+                    del args[:]
+            elif arg in ["-p", "+p"] and args:
+                pend = arg[0] == "-" and "prepend" or "append"
+                _pkgpath = args.pop(0)
+                cg.exportvar("SSMUSE_PENDMODE", pend)
+                t0 = time.time()
+                _, pkgpath = augmentssmpath("package", _pkgpath)
+                if not (lazy and loadlazy(arg, pkgpath)):
+                    loadpackage(pend, pkgpath, t0)
+                if cg.hasrerunpoint(args):
+                    # for the rerun; otherwise, exported once at the end
+                    exportloads()
+                if cg.ssmuseonchangeddeps(args):
+                    del args[:]
+            elif arg in ["-x", "+x"] and args:
+                _xpath = args.pop(0)
+                pathtype, xpath = augmentssmpath(None, _xpath)
+                if pathtype == "dgroup":
+                    args = [arg[0]+"g", _xpath]+args
+                elif pathtype == "directory":
+                    args = [arg[0]+"f", _xpath]+args
+                elif pathtype == "domain":
+                    args = [arg[0]+"d", _xpath]+args
+                elif pathtype == "package":
+                    args = [arg[0]+"p", _xpath]+args
+                else:
+                    printe("fatal: loadargs: invalid path (%s)" % (_xpath,))
+                    sys.exit(1)
+            elif arg == "--append":
+                pend = "append"
+                cg.log("info", "pendmode: append")
+            elif arg == "--prepend":
+                pend = "prepend"
+                cg.log("info", "pendmode: prepend")
+            elif arg == "--swap" and len(args) > 1:
+                _oldpath = args.pop(0)
+                _newpath = args.pop(0)
+                cg.unexportvar("SSMUSE_PENDMODE")
+                swapload(_oldpath, _newpath)
+            elif arg == "--unload" and args:
+                _path = args.pop(0)
+                unload(_path)
+            elif arg == "--lazy":
+                lazy = True
+                cg.log("info", "lazy: on")
+            elif arg == "-v":
+                verbose = True
+            else:
+                printe("fatal: unknown argument (%s)" % (arg,))
+                sys.exit(1)
+        except ProbeTimeout as e:
+            # skip item entirely
+            del cg.segs[mark[0]:]
+            del logrecords[mark[1]:]
+            del cg.pathops[mark[2]:]
+            del cg.loads[mark[3]:]
+            loadedpkgpaths.clear()
+            loadedpkgpaths.update(mark[4])
+            item = _args[:max(1, len(_args)-len(args))]
+            cg.log("warning", "skipping (%s): %s" % (" ".join(item), e))
+    cg.unexportvar("SSMUSE_PENDMODE")
+    exportloads()
+    deduppaths()
+
 def log(path, message):
+    """Hold log record until flushlog().
+    """
     if logger:
         if logpathprefixes:
             for pref in logpathprefixes:
@@ -436,7 +1374,37 @@ def log(path, message):
                     break
             else:
                 return
-        logger.info(message)
+        logrecords.append(message)
+
+def reportenvsize(envpaths):
+    """Report expected sizes (bytes, as copied by exec) of VARS and of
+    the whole environment; warn if over SSMUSE_ENV_BUDGET.
+    """
+    environ = dict(os.environ)
+    if cg.loadedvalue != environ.get("SSMUSE_LOADED", ""):
+        # as exported by exportloads()
+        environ["SSMUSE_LOADED"] = cg.loadedvalue
+    total = 0
+    for name, value in environ.items():
+        if name not in envpaths:
+            total += len(name)+len(value)+2
+    for name in VARS:
+        value = ":".join(envpaths[name])
+        if value or name in os.environ:
+            size = len(name)+len(value)+2
+            total += size
+            cg.log("info", "envsize: (%s) (%s bytes) (%s entries)" % (name, size, len(envpaths[name])))
+    cg.log("info", "envsize: total (%s bytes)" % (total,))
+    if envbudget and total > envbudget:
+        printe("warning: environment size (%s bytes) exceeds SSMUSE_ENV_BUDGET (%s bytes)" % (total, envbudget))
+
+def recordload(path, start):
+    """Record the contributions of a load: the path updates since
+    start (index into cg.pathops).
+    """
+    contribs = {}
+    applypathops(contribs, cg.pathops[start:])
+    cg.loads.append((path, contribs))
 
 def resolvepcvar(s):
     """Resolve instances of %varname% in s as environment variables.
@@ -450,6 +1418,173 @@ def resolvepcvar(s):
         l2.extend([v, l[i+1]])
     return "".join(l2)
 
+def resolvepkgdep(pkgpath, depname):
+    """Resolve a dependency name of a package: first alongside the
+    package, then along the SSMUSE_PATH/SSMUSE_BASE. Only (absolute)
+    package paths are returned.
+    """
+    path = None
+    if not depname.startswith("/"):
+        path = matchpkgpath(joinpath(dirname(pkgpath), depname))
+    if path == None:
+        _, path = augmentssmpath("package", depname)
+    if path == None or not path.startswith("/") or not is_pkgpath(path):
+        return None
+    return path
+
+def resolvepkgname(pkgdir, pkgname):
+    """Resolve a package name, bare (e.g., foo) or with version
+    constraints (e.g., foo>=1.2,<2), to the package of the highest
+    matching version, on the best platform, found in pkgdir.
+    """
+    name, constraints = splitpkgspec(pkgname)
+    entries = getpkgindex(pkgdir).get(name)
+    if not entries:
+        return None
+    ranks = dict([(platform, i) for i, platform in enumerate(platforms)])
+    candidates = [(version, platform) for version, platform in entries
+        if platform in ranks and matchversion(version, constraints)]
+    candidates.sort(key=lambda t: ranks[t[1]])
+    candidates.sort(key=lambda t: versionkey(t[0]), reverse=True)
+    for version, platform in candidates:
+        path = joinpath(pkgdir, "%s_%s_%s" % (name, version, platform))
+        if is_pkgpath(path):
+            cg.log("info", "resolvepkgname: (%s) (%s)" % (pkgname, path))
+            return path
+    return None
+
+def resolvepkggraph(pkgpath):
+    """Return the package and its transitive dependencies, ordered
+    with dependencies before dependents (each package once).
+
+    The result is memoized per platform list, for the invocation and
+    (with SSMUSE_CACHE) on disk. Installed packages are versioned and
+    do not change, but installing or removing packages can change how
+    dependencies resolve. So the cached graph records the control
+    files read and the directories searched while it was built, and
+    is validated by the search path (base directories) and their
+    mtimes.
+    """
+    key = (" ".join(platforms), pkgpath)
+    if key in pkggraphs:
+        return pkggraphs[key]
+
+    basedirs = getbasedirs()
+
+    def getmtime(path):
+        try:
+            return str(probe(os.stat, path).st_mtime)
+        except OSError:
+            return "-"
+
+    def build():
+        done = set()
+        order = []
+        visiting = set()
+        watched = []
+
+        def watch(path):
+            # stat before use, so that the token matches what was seen
+            if path not in watched:
+                watched.append(path)
+                getmtime(path)
+
+        def visit(path):
+            if path in done:
+                return
+            if path in visiting:
+                cg.log("warning", "resolvepkggraph: dependency cycle at (%s)" % (path,))
+                return
+            visiting.add(path)
+            watch(joinpath(path, ".ssm.d/control"))
+            for depname in getpkgdeps(path):
+                # where resolvepkgdep() looks
+                if depname.startswith("/"):
+                    watch(dirname(depname))
+                else:
+                    watch(dirname(joinpath(dirname(path), depname)))
+                    for basedir in basedirs:
+                        watch(dirname(joinpath(basedir, depname)))
+                deppath = resolvepkgdep(path, depname)
+                if deppath == None:
+                    cg.log("warning", "resolvepkggraph: cannot resolve dependency (%s) of (%s)" % (depname, path))
+                    continue
+                visit(deppath)
+            visiting.discard(path)
+            done.add(path)
+            order.append(path)
+
+        visit(pkgpath)
+        # <order>\n\n<watched>
+        return "%s\n\n%s" % ("\n".join(order), "\n".join(watched))
+
+    def gettoken(value):
+        watched = value.partition("\n\n")[2].split("\n")
+        return "%s|%s" % (":".join(basedirs), " ".join([getmtime(path) for path in watched]))
+
+    value = cacheget("pkggraph:%s:%s" % key, gettoken, build)
+    pkggraphs[key] = value.partition("\n\n")[0].split("\n")
+    return pkggraphs[key]
+
+def swapload(_oldpath, _newpath):
+    """Replace a loaded domain, package, or directory by another. The
+    entries recorded for the old one are removed and those of the new
+    one are put in their place, in each variable. Untouched loads
+    are not probed again.
+    """
+    global deferpaths
+
+    oldpath, contribs = findload(_oldpath)
+    if oldpath == None:
+        printe("fatal: swapload: not loaded (%s)" % (_oldpath,))
+        sys.exit(1)
+    pathtype, newpath = sensepath(_newpath)
+    if pathtype == None:
+        printe("fatal: swapload: invalid path (%s)" % (_newpath,))
+        sys.exit(1)
+    cg.log("info", "swapload: (%s) (%s)" % (oldpath, newpath))
+    cg.loads.append((oldpath, None))
+
+    # collect (not generate) the path updates of the new load
+    mark = len(cg.pathops)
+    deferpaths = True
+    try:
+        if pathtype == "dgroup":
+            loaddgroup("prepend", newpath)
+        elif pathtype == "domain":
+            loaddomain("prepend", newpath)
+        elif pathtype == "package":
+            loadpackage("prepend", newpath)
+        else:
+            loaddirectory("prepend", newpath)
+    finally:
+        deferpaths = False
+    inserts = {}
+    applypathops(inserts, cg.pathops[mark:])
+    del cg.pathops[mark:]
+
+    for name in VARS:
+        __replacepaths(name, contribs.get(name, []), inserts.get(name, []))
+
+def sensepath(path):
+    """Return (pathtype, path) as for -x, with packages matched;
+    (None, None) if nothing is found.
+    """
+    try:
+        pathtype, xpath = augmentssmpath(None, path)
+        if pathtype == "package":
+            _, xpath = augmentssmpath("package", path)
+    except OSError:
+        return None, None
+    return pathtype, xpath
+
+def setplatforms(l):
+    global platforms, platform0, revplatforms
+
+    platforms = l
+    platform0 = platforms and platforms[0] or None
+    revplatforms = platforms[::-1]
+
 def setuplogger():
     global logger, logpathprefixes
 
@@ -492,13 +1627,26 @@ def setuplogger():
             logger.addHandler(lh)
 
             if "SSMUSE_LOG_FILTER" in os.environ:
-                logpathprefixes = map(realpath, os.environ["SSMUSE_LOG_FILTER"].split(":"))
+                logpathprefixes = [realpath(path) for path in os.environ["SSMUSE_LOG_FILTER"].split(":")]
         except:
             sys.stderr.write("warning: no logging\n")
             #import traceback
             #traceback.print_exc()
             logger = None
 
+def unload(_path):
+    """Remove the entries recorded for a loaded domain, package, or
+    directory.
+    """
+    path, contribs = findload(_path)
+    if path == None:
+        cg.log("warning", "unload: not loaded (%s)" % (_path,))
+        return
+    cg.log("info", "unload: (%s)" % (path,))
+    for name in VARS:
+        __replacepaths(name, contribs.get(name, []), [])
+    cg.loads.append((path, None))
+
 HELP = """\
 usage: ssmuse-sh [options]
        ssmuse-csh [options]
@@ -515,23 +1663,74 @@ Options:
 -h|--help
         Print help.
 -p|+p <pkgpath>
-        Load package. See -x and +x.
+        Load package and, transitively, the packages listed in the
+        Depends field of its control file. See -x and +x. A package
+        may be named in full (<name>_<version>_<platform>), without
+        platform (<name>_<version>), by name only (highest version),
+        or by name with version constraints (e.g., foo>=1.2,<2; ops
+        are =, ==, !=, <, <=, >, >=). The best platform is used.
 -x|+x <xpath>
         Load one of domain, directory, package. ssmuse automatically
         senses what is at the xpath location.
+--lazy
+        Do not load the domain groups, domains, and packages which
+        follow; load each on the first use of one of its commands
+        (bash only, via a function stub per command which loads the
+        domain group, domain, or package into the shell, then runs
+        the command; later calls are native). Elsewhere, these are
+        loaded as usual.
+--memo-clear
+        Clear the memo of generated code kept in the current shell
+        when SSMUSE_MEMO is set (to the number of entries for
+        ssmuse-sh; ssmuse-csh keeps one). Use it after changes to
+        domains, or to the environment, not seen by ssmuse.
 --noeval
         Do not evaluate. Useful for debugging.
+--swap <oldpath> <newpath>
+        Replace a loaded domain, package, or directory by another
+        (sensed as for -x), in place: the entries added by the old
+        one are removed and those of the new one take their
+        position. Loads are recorded in SSMUSE_LOADED; the
+        dependencies of a package are loads of their own. Settings
+        made by profile scripts are not undone.
+--unload <path>
+        Remove the entries added by a loaded domain, package, or
+        directory (see --swap).
+--noeval --platforms-set <platforms>[;...]
+        Generate code for each of several platform lists (platforms
+        separated by spaces or commas), in one pass, for use on other
+        hosts (e.g., in job scripts). Each block applies where the
+        first platform of SSMUSE_PLATFORMS matches. Must be first,
+        after --noeval. With __ssmuse, use the "json" shell type for
+        a structured document.
 
 Use leading - (e.g., -x) to prepend new paths, leading + to append
 new paths."""
 
 if __name__ == "__main__":
-    hostname = socket.gethostname()
+    cachedir = os.environ.get("SSMUSE_CACHE")
+    cachewait = float(os.environ.get("SSMUSE_CACHE_WAIT", 2))
+    deadroots = set()
+    deferpaths = False
+    envbudget = None
+    hostname = os.uname()[1]
+    loadedpkgpaths = set()
     logger = None
     logpathprefixes = []
+    logrecords = []
+    mountroots = None
     nowst = time.strftime("%Y/%m/%dT%H:%M:%S", time.gmtime())
+    oneline = False
+    pkggraphs = {}
+    pkgindexes = {}
     platform0 = None
+    platformsset = None
+    probedeadline = float("inf")
+    probes = {}
+    probetimeout = None
+    prune = os.environ.get("SSMUSE_PRUNE")
     selfpid = os.getpid()
+    starttime = time.time()
     usetmp = False
     verbose = os.environ.get("SSMUSE_VERBOSE")
 
@@ -541,103 +1740,85 @@ if __name__ == "__main__":
         printe("fatal: missing shell type")
         sys.exit(1)
 
-    shell = args.pop(0)
-    if shell == "sh":
-        cg = ShCodeGenerator()
-    elif shell == "csh":
-        cg = CshCodeGenerator()
-    else:
+    cgtype = args.pop(0)
+    cg = getcodegenerator(cgtype)
+    if cg == None:
         printe("fatal: bad shell type")
         sys.exit(1)
+    # shell of profile scripts
+    shell = cgtype == "json" and "sh" or cgtype
 
     if args and args[0] in ["-h", "--help"]:
-        print HELP
+        print(HELP)
         sys.exit(0)
 
-    if args and args[0] == "--tmp":
+    if args and args[0] == "--eval":
+        # code is eval'ed by the caller: no tmp file, single line for csh
+        args.pop(0)
+        oneline = True
+    elif args and args[0] == "--tmp":
         args.pop(0)
         usetmp = True
 
+    if args and args[0] == "--platforms-set" and len(args) > 1:
+        args.pop(0)
+        platformsset = [l.replace(",", " ").split() for l in args.pop(0).split(";")]
+        platformsset = [l for l in platformsset if l]
+        if oneline:
+            printe("fatal: --platforms-set cannot be eval'ed")
+            sys.exit(1)
+
+    if os.environ.get("SSMUSE_PROBE_TIMEOUT"):
+        # <seconds>[:<total seconds>]
+        try:
+            t = os.environ["SSMUSE_PROBE_TIMEOUT"].split(":", 1)
+            probetimeout = float(t[0])
+            if len(t) > 1:
+                probedeadline = starttime+float(t[1])
+        except ValueError:
+            printe("warning: bad SSMUSE_PROBE_TIMEOUT")
+
+    if os.environ.get("SSMUSE_ENV_BUDGET"):
+        # <bytes>
+        try:
+            envbudget = int(os.environ["SSMUSE_ENV_BUDGET"])
+        except ValueError:
+            printe("warning: bad SSMUSE_ENV_BUDGET")
+
     setuplogger()
 
     try:
-        heredir = realpath(dirname(sys.argv[0]))
-
-        platforms = getplatforms()
-        platform0 = platforms and platforms[0] or None
-        revplatforms = platforms[::-1]
+        heredir = os.path.realpath(dirname(sys.argv[0]))
 
         depnames = getdepnames()
 
-        cg.comment("host (%s)" % (socket.gethostname(),))
-        cg.comment("date (%s)" % (time.asctime(),))
-        cg.comment("platforms (%s)" % (" ".join(platforms),))
-        cg.comment("depnames (%s)" % (" ".join(depnames),))
-        for name in ["SSMUSE_BASE", "SSMUSE_DGROUPNAMES", "SSMUSE_LOG",
-            "SSMUSE_PATH", "SSMUSE_PLATFORMS", "SSMUSE_XINCDIRS",
-            "SSMUSE_XLIBDIRS"]:
-            value = os.environ.get(name, "-").replace("\n\t", "  ")
-            cg.comment("env (%s) (%s)" % (name, value))
-
-        while args:
-            arg = args.pop(0)
-            if arg in ["-d", "+d"] and args:
-                pend = arg[0] == "-" and "prepend" or "append"
-                _dompath = args.pop(0)
-                cg.exportvar("SSMUSE_PENDMODE", pend)
-                _, dompath = augmentssmpath("domain", _dompath)
-                loaddomain(pend, dompath)
-                cg.ssmuseonchangeddeps(args)
-            elif arg in ["-f", "+f"] and args:
-                pend = arg[0] == "-" and "prepend" or "append"
-                _dirpath = args.pop(0)
-                cg.unexportvar("SSMUSE_PENDMODE")
-                _, dirpath = augmentssmpath("directory", _dirpath)
-                loaddirectory(pend, dirpath)
-            elif arg in ["-g", "+g"] and args:
-                pend = args[0] == "-" and "prepend" or "append"
-                _dgpath = args.pop(0)
-                cg.exportvar("SSMUSE_PENDMODE", pend)
-                _, dgpath = augmentssmpath("dgroup", _dgpath)
-                loaddgroup(pend, dgpath)
-                cg.ssmuseonchangeddeps(args)
-            elif arg in ["-p", "+p"] and args:
-                pend = arg[0] == "-" and "prepend" or "append"
-                _pkgpath = args.pop(0)
-                cg.exportvar("SSMUSE_PENDMODE", pend)
-                _, pkgpath = augmentssmpath("package", _pkgpath)
-                loadpackage(pend, pkgpath)
-                cg.ssmuseonchangeddeps(args)
-            elif arg in ["-x", "+x"] and args:
-                _xpath = args.pop(0)
-                pathtype, xpath = augmentssmpath(None, _xpath)
-                if pathtype == "dgroup":
-                    args = [arg[0]+"g", _xpath]+args
-                elif pathtype == "directory":
-                    args = [arg[0]+"f", _xpath]+args
-                elif pathtype == "domain":
-                    args = [arg[0]+"d", _xpath]+args
-                elif pathtype == "package":
-                    args = [arg[0]+"p", _xpath]+args
-            elif arg == "--append":
-                pend = "append"
-                cg.log("info", "pendmode: append")
-            elif arg == "--prepend":
-                pend = "prepend"
-                cg.log("info", "pendmode: prepend")
-            elif arg == "-v":
-                verbose = True
-            else:
-                printe("fatal: unknown argument (%s)" % (arg,))
-                sys.exit(1)
-        cg.unexportvar("SSMUSE_PENDMODE")
-        deduppaths()
+        if platformsset == None:
+            setplatforms(getplatforms())
+            commentheader()
+            loadargs(args)
+        else:
+            # one block per platform list; probes are shared
+            cgs = []
+            for l in platformsset:
+                cg = getcodegenerator(cgtype)
+                loadedpkgpaths = set()
+                setplatforms(l)
+                commentheader()
+                loadargs(args[:])
+                cgs.append((l, cg))
+            cg = getcodegenerator(cgtype)
+            cg.platformblocks(cgs)
+        flushlog()
 
         # prepare to write out (to stdout or tempfile)
         if not usetmp:
+            # single write of complete code; caller checks exit status
             sys.stdout.write(str(cg))
+            sys.stdout.flush()
         else:
             try:
+                import tempfile
+
                 fd, tmpname = tempfile.mkstemp(prefix="ssmuse", dir="/tmp")
                 out = os.fdopen(fd, "w")
 
@@ -647,7 +1828,7 @@ if __name__ == "__main__":
                 cg.comment("")
                 cg.segs = cg.segs[-3:]+cg.segs[:-3]
                 out.write(str(cg))
-                print "%s" % (tmpname,)
+                print("%s" % (tmpname,))
                 out.close()
             except:
                 #import traceback
@@ -655,9 +1836,22 @@ if __name__ == "__main__":
                 printe("fatal: could not create tmp file")
                 sys.exit(1)
 
+        if "threading" in sys.modules and sys.modules["threading"].active_count() > 1:
+            # hung probe threads would keep stdout (and the caller)
+            # waiting; close it and leave them behind
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.close(1)
+            os.close(2)
+            os._exit(0)
+
     except SystemExit:
         raise
     except:
         #import traceback
         #traceback.print_exc()
         printe("abort: unrecoverable error")
+        sys.exit(1)
+    finally:
+        # records of completed loads, also on failure
+        flushlog()
@@ -0,0 +1,210 @@
+#! /usr/bin/python3 -IS
+#
+# ssmuse_logstats.py
+
+import math
+import sys
+
+# record type -> (host, platform, path, elapsed, total, pid) field
+# offsets relative to the record type field; pid is optional (older
+# records)
+RECORD_OFFSETS = {
+    "loaddomain": (2, 3, 9, 10, 11, 12),
+    "loaddirectory": (2, 3, 7, 8, 9, 10),
+    "loadpackage": (2, 3, 7, 8, 9, 10),
+}
+
+class Histogram:
+    """Fixed-size, log-scale histogram for bounded memory
+    percentiles (relative error is bounded by the bucket ratio).
+    """
+
+    MIN = 0.0001
+    RATIO = 1.05
+    NBUCKETS = 400
+
+    def __init__(self):
+        self.buckets = [0]*self.NBUCKETS
+        self.count = 0
+        self.max = 0.0
+        self.sum = 0.0
+
+    def add(self, value):
+        if value <= self.MIN:
+            i = 0
+        else:
+            i = int(math.log(value/self.MIN)/math.log(self.RATIO))+1
+            i = min(i, self.NBUCKETS-1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+        self.sum += value
+
+    def percentile(self, p):
+        """Return upper bound of bucket holding the p-th percentile.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count*p/100.0)))
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= rank:
+                return min(self.MIN*self.RATIO**i, self.max)
+        return self.max
+
+def openlog(path):
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        import gzip
+
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, errors="replace")
+
+def parserecord(line):
+    """Return (type, host, platform, path, elapsed, total, pid) or
+    None.
+
+    Anything before the timestamp field (e.g., a syslog prefix) is
+    ignored.
+    """
+    fields = line.rstrip("\n").split("|")
+    for i, field in enumerate(fields[:3]):
+        offsets = RECORD_OFFSETS.get(field)
+        if offsets:
+            break
+    else:
+        return None
+    if len(fields) <= i+offsets[4]:
+        # older record, without timings
+        return None
+    try:
+        host, platform, path = [fields[i+j] for j in offsets[:3]]
+        elapsed = float(fields[i+offsets[3]])
+        total = float(fields[i+offsets[4]])
+    except ValueError:
+        return None
+    if not (math.isfinite(elapsed) and math.isfinite(total)):
+        return None
+    if len(fields) > i+offsets[5]:
+        pid = fields[i+offsets[5]]
+    else:
+        pid = None
+    return field, host, platform, path, elapsed, total, pid
+
+def printstats(title, hists, percentiles, limit):
+    print("%s" % (title,))
+    header = "%10s" % ("count",)+"".join(["%10s" % ("p%s" % (p,)) for p in percentiles])+"%10s  %s" % ("max", "key")
+    print(header)
+    items = sorted(hists.items(), key=lambda t: (-t[1].count, t[0]))
+    if limit:
+        items = items[:limit]
+    for key, h in items:
+        print("%10d" % (h.count,)
+            +"".join(["%10.3f" % (h.percentile(float(p)),) for p in percentiles])
+            +"%10.3f  %s" % (h.max, key))
+    print("")
+
+HELP = """\
+usage: ssmuse-logstats [options] [<logfile> ...]
+
+Report load latency statistics (seconds) from ssmuse log records
+(SSMUSE_LOG), per domain/package/directory, host, and platform.
+Records are streamed from the log files (plain, .gz, or - for
+stdin; default stdin) and held in fixed-size histograms, so memory
+does not grow with the size of the logs. Syslog exports may be used
+as is.
+
+Options:
+--by <group>[,...]
+        Groups to report: item, host, platform, total (invocation
+        time per host). Default is item,host,platform,total.
+-n <count>
+        Report at most <count> keys per group (most frequent first).
+-p <pct>[,...]
+        Percentiles to report. Default is 50,90,99."""
+
+def main(args):
+    groups = ["item", "host", "platform", "total"]
+    limit = None
+    paths = []
+    percentiles = ["50", "90", "99"]
+
+    while args:
+        arg = args.pop(0)
+        if arg in ["-h", "--help"]:
+            print(HELP)
+            sys.exit(0)
+        elif arg == "--by" and args:
+            groups = args.pop(0).split(",")
+        elif arg == "-n" and args:
+            limit = int(args.pop(0))
+        elif arg == "-p" and args:
+            percentiles = args.pop(0).split(",")
+        elif arg.startswith("-") and arg != "-":
+            sys.stderr.write("fatal: unknown argument (%s)\n" % (arg,))
+            sys.exit(1)
+        else:
+            paths.append(arg)
+    if not paths:
+        paths = ["-"]
+
+    stats = dict([(name, {}) for name in groups])
+    # invocation totals are repeated on each of its records; drop
+    # repeats seen recently (bounded), by invocation (host, pid, and
+    # total) or, for older records, by timestamp and total
+    recenttotals = {}
+    nrecords = 0
+    nskipped = 0
+
+    for path in paths:
+        try:
+            f = openlog(path)
+        except (IOError, OSError):
+            sys.stderr.write("error: cannot open log (%s)\n" % (path,))
+            continue
+        for line in f:
+            rec = parserecord(line)
+            if rec == None:
+                nskipped += 1
+                continue
+            nrecords += 1
+            rtype, host, platform, ipath, elapsed, total, pid = rec
+            for name, key, value in [
+                ("item", ipath, elapsed),
+                ("host", host, elapsed),
+                ("platform", platform, elapsed)]:
+                if name in stats:
+                    stats[name].setdefault(key, Histogram()).add(value)
+            if "total" in stats:
+                if pid != None:
+                    tkey = (host, pid, total)
+                else:
+                    tkey = (line.split("|", 1)[0], host, total)
+                if tkey not in recenttotals:
+                    if len(recenttotals) > 1000:
+                        recenttotals.clear()
+                    recenttotals[tkey] = True
+                    stats["total"].setdefault(host, Histogram()).add(total)
+        if f != sys.stdin:
+            f.close()
+
+    titles = {
+        "item": "load time per domain/package/directory",
+        "host": "load time per host",
+        "platform": "load time per platform",
+        "total": "invocation time per host",
+    }
+    print("records (%s) skipped (%s)\n" % (nrecords, nskipped))
+    for name in groups:
+        if name in stats:
+            printstats(titles.get(name, name), stats[name], percentiles, limit)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except KeyboardInterrupt:
+        sys.exit(1)
+    except BrokenPipeError:
+        sys.exit(0)
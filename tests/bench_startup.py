@@ -0,0 +1,86 @@
+#! /usr/bin/python3
+#
+# bench_startup.py
+#
+# Cold start benchmark of __ssmuse for a typical -d invocation against
+# a synthetic domain. Exits non-zero if the median run time is over
+# budget.
+
+import os
+from os.path import dirname
+from os.path import join as joinpath
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SSMUSE_PY = joinpath(dirname(dirname(os.path.realpath(__file__))), "static/lib/ssmuse/__ssmuse.py")
+
+HELP = """\
+usage: bench_startup.py [-b <budget>] [-n <count>]
+
+Time "python3 -IS __ssmuse.py sh -d <domain>" against a synthetic
+domain (<count> runs; default 20). Fail (exit 1) if the median run
+time is over <budget> seconds (default 0.1)."""
+
+def mkdomain(root):
+    dompath = joinpath(root, "dom")
+    os.makedirs(joinpath(dompath, "etc/ssm.d"))
+    for platform in ["bench-x", "all"]:
+        for name in ["bin", "include", "lib", "share/man"]:
+            os.makedirs(joinpath(dompath, platform, name))
+        for i in range(50):
+            open(joinpath(dompath, platform, "bin", "cmd%s" % (i,)), "w").close()
+        open(joinpath(dompath, platform, "lib", "libx.so"), "w").close()
+        open(joinpath(dompath, platform, "include", "x.h"), "w").close()
+    return dompath
+
+def main(args):
+    budget = 0.1
+    count = 20
+
+    while args:
+        arg = args.pop(0)
+        if arg in ["-h", "--help"]:
+            print(HELP)
+            sys.exit(0)
+        elif arg == "-b" and args:
+            budget = float(args.pop(0))
+        elif arg == "-n" and args:
+            count = int(args.pop(0))
+        else:
+            sys.stderr.write("fatal: unknown argument (%s)\n" % (arg,))
+            sys.exit(1)
+
+    root = tempfile.mkdtemp(prefix="ssmuse-bench")
+    try:
+        dompath = mkdomain(root)
+        env = {
+            "HOME": root,
+            "PATH": "/usr/bin:/bin",
+            "SSMUSE_PLATFORMS": "bench-x all",
+        }
+        cmd = [sys.executable, "-IS", SSMUSE_PY, "sh", "-d", dompath]
+        times = []
+        for i in range(count):
+            t0 = time.time()
+            p = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            times.append(time.time()-t0)
+            if p.returncode != 0 or b"export PATH" not in p.stdout:
+                sys.stderr.write("fatal: bad run (%s)\n%s" % (p.returncode, p.stderr.decode()))
+                sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+    times.sort()
+    median = times[len(times)//2]
+    print("runs (%s) min (%.3f) median (%.3f) max (%.3f) budget (%.3f)" \
+        % (count, times[0], median, times[-1], budget))
+    if median > budget:
+        print("FAIL: median over budget")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
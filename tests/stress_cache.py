@@ -0,0 +1,142 @@
+#! /usr/bin/python3
+#
+# stress_cache.py
+#
+# Run many concurrent __ssmuse processes, sharing one SSMUSE_CACHE,
+# against a synthetic tree. Exits non-zero if any run fails, if the
+# runs do not all generate the same code, or if the cache is left
+# with partial entries.
+
+import os
+from os.path import dirname
+from os.path import join as joinpath
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SSMUSE = joinpath(dirname(dirname(os.path.realpath(__file__))), "static/bin/__ssmuse")
+
+HELP = """\
+usage: stress_cache.py [-n <count>] [-r <rounds>]
+
+Start <count> (default 100) concurrent __ssmuse processes per round
+(default 3 rounds: cold cache, warm cache, invalidated entries)
+against a synthetic tree of domains and packages (with Depends),
+loaded by bare package name so that all cached data (platforms,
+package indexes, package graphs) is exercised."""
+
+def mktree(root, platforms):
+    base = joinpath(root, "base")
+    for i in range(5):
+        dompath = joinpath(base, "dom%s" % (i,))
+        os.makedirs(joinpath(dompath, "etc/ssm.d"))
+        for platform in platforms:
+            os.makedirs(joinpath(dompath, platform, "bin"))
+            open(joinpath(dompath, platform, "bin", "cmd%s" % (i,)), "w").close()
+    pkgnames = []
+    for i in range(20):
+        name = "pkg%s" % (i,)
+        pkgnames.append(name)
+        for version in ["1.0", "1.1", "2.0"]:
+            pkgpath = joinpath(base, "%s_%s_%s" % (name, version, platforms[-1]))
+            os.makedirs(joinpath(pkgpath, ".ssm.d"))
+            os.makedirs(joinpath(pkgpath, "bin"))
+            with open(joinpath(pkgpath, ".ssm.d/control"), "w") as f:
+                f.write("Package: %s\nVersion: %s\n" % (name, version))
+                if i > 0:
+                    f.write("Depends: pkg%s_2.0\n" % (i-1,))
+    return base, pkgnames
+
+def runround(label, count, args, env, cachedir):
+    t0 = time.time()
+    procs = [subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for i in range(count)]
+    outs = set()
+    nfailed = 0
+    nstale = 0
+    nwarnings = 0
+    for p in procs:
+        out, err = p.communicate()
+        if p.returncode != 0:
+            nfailed += 1
+            sys.stderr.write("error: run failed (%s): %s" % (p.returncode, err.decode()))
+        # drop the header (date varies) and cache messages, which
+        # differ between runs
+        out = out.decode()
+        lines = [line for line in out.split("\n")
+            if not line.startswith("#") and "cacheget:" not in line]
+        outs.add(re.sub(r'^echo "\[\d+\]', 'echo "[pid]', "\n".join(lines), flags=re.M))
+        nstale += out.count("cacheget: using stale")
+        nwarnings += out.count("[warning] cacheget")
+    partial = [name for name in os.listdir(cachedir)
+        if not name.endswith(".lock") and name.rsplit(".", 1)[-1].isdigit()]
+    print("%-12s runs (%s) failed (%s) distinct outputs (%s) stale (%s) cache warnings (%s) partial entries (%s) time (%.2f)" \
+        % (label, count, nfailed, len(outs), nstale, nwarnings, len(partial), time.time()-t0))
+    return nfailed == 0 and len(outs) == 1 and not partial
+
+def main(args):
+    count = 100
+    rounds = 3
+
+    while args:
+        arg = args.pop(0)
+        if arg in ["-h", "--help"]:
+            print(HELP)
+            sys.exit(0)
+        elif arg == "-n" and args:
+            count = int(args.pop(0))
+        elif arg == "-r" and args:
+            rounds = int(args.pop(0))
+        else:
+            sys.stderr.write("fatal: unknown argument (%s)\n" % (arg,))
+            sys.exit(1)
+
+    # platforms are sensed (and cached) as on a real host
+    platforms = subprocess.check_output([joinpath(dirname(SSMUSE), "ssmuse_platforms")]).decode().split()
+    if not platforms:
+        sys.stderr.write("fatal: no platforms sensed\n")
+        sys.exit(1)
+
+    root = tempfile.mkdtemp(prefix="ssmuse-stress")
+    ok = True
+    try:
+        base, pkgnames = mktree(root, platforms)
+        cachedir = joinpath(root, "cache")
+        os.mkdir(cachedir)
+        env = {
+            "HOME": root,
+            "PATH": "%s:/usr/bin:/bin" % (dirname(SSMUSE),),
+            "SSMUSE_BASE": base,
+            "SSMUSE_CACHE": cachedir,
+            "SSMUSE_VERBOSE": "1",
+        }
+        args = [SSMUSE, "sh"]
+        for i in range(5):
+            args.extend(["-d", "dom%s" % (i,)])
+        for name in pkgnames[-5:]:
+            args.extend(["-p", name])
+        for i in range(rounds):
+            if i == 0:
+                label = "cold"
+            elif i % 2 == 1:
+                label = "warm"
+            else:
+                # invalidate: new control file mtimes and a new package
+                label = "invalidated"
+                for name in pkgnames:
+                    os.utime(joinpath(base, "%s_2.0_%s/.ssm.d/control" % (name, platforms[-1])))
+                os.makedirs(joinpath(base, "extra%s_1.0_%s" % (i, platforms[-1])))
+            ok = runround(label, count, args, env, cachedir) and ok
+    finally:
+        shutil.rmtree(root)
+
+    if not ok:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+#! /usr/bin/python3
+#
+# test_cleanpath.py
+#
+# Checks of ssmuse_cleanpath, both the ksh93 code and the awk fallback
+# (used when not run by ksh93). Without ksh93, the ksh code is run by
+# bash, which supports the same constructs. Exits non-zero on failure.
+
+import os
+from os.path import dirname
+from os.path import join as joinpath
+import shutil
+import subprocess
+import sys
+
+CLEANPATH = joinpath(dirname(dirname(os.path.realpath(__file__))), "static/lib/ssmuse/ssmuse_cleanpath.ksh")
+
+# (args, expected)
+CASES = [
+    # duplicates
+    (["a:b:a:c"], "a:b:c"),
+    (["a:b:c", "", ""], "a:b:c"),
+    # drop
+    (["a:b:c", "b"], "a:c"),
+    (["a:b:c:d", "c:a", "-"], "b:d"),
+    (["a:b:c", "x"], "a:b:c"),
+    # insert at first drop
+    (["a:b:c", "b", "x:y:a"], "a:x:y:c"),
+    (["a:b:c:d", "c:a", "z"], "z:b:d"),
+    # insert, drop not found: prepend
+    (["a:b", "-", "x:b"], "x:a:b"),
+    (["a:b", "q", "x"], "x:a:b"),
+    (["", "-", "x"], "x"),
+    # empty and trailing entries
+    (["a:b:", "", ""], "a:b:"),
+    (["a::b:a:"], "a::b"),
+    (["::a:b::c:", "c", "q"], ":a:b:q"),
+    ([":", "-", "-"], ""),
+]
+
+def getrunners():
+    """Return (name, argv prefix, env) for each code path.
+    """
+    env = dict(os.environ)
+    env.pop("KSH_VERSION", None)
+    runners = [("awk", ["sh", CLEANPATH], env)]
+    ksh = shutil.which("ksh93")
+    if ksh:
+        runners.append(("ksh93", [ksh, CLEANPATH], env))
+    else:
+        env = dict(env)
+        env["KSH_VERSION"] = "bash"
+        runners.append(("ksh (bash)", ["bash", CLEANPATH], env))
+    return runners
+
+def main():
+    nfailed = 0
+    for name, argv, env in getrunners():
+        for args, expected in CASES:
+            p = subprocess.run(argv+args, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            value = p.stdout.decode().rstrip("\n")
+            ok = p.returncode == 0 and value == expected
+            print("%s %s %s" % (ok and "OK  " or "FAIL", name, args))
+            if not ok:
+                print("    got (%s) expected (%s) stderr (%s)" % (value, expected, p.stderr.decode()))
+                nfailed += 1
+    if nfailed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
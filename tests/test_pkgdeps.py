@@ -0,0 +1,131 @@
+#! /usr/bin/python3
+#
+# test_pkgdeps.py
+#
+# Checks of package dependency (Depends) resolution. Exits non-zero
+# on failure. (check_* rather than test_*: not pytest tests.)
+
+import json
+import os
+from os.path import dirname
+from os.path import join as joinpath
+import shutil
+import subprocess
+import sys
+import tempfile
+
+SSMUSE = joinpath(dirname(dirname(os.path.realpath(__file__))), "static/bin/__ssmuse")
+
+def mkpkg(base, name, depends=None, maintainer=None):
+    pkgpath = joinpath(base, name)
+    os.makedirs(joinpath(pkgpath, ".ssm.d"))
+    os.makedirs(joinpath(pkgpath, "bin"))
+    open(joinpath(pkgpath, "bin", "cmd"), "w").close()
+    with open(joinpath(pkgpath, ".ssm.d/control"), "w", encoding="latin-1") as f:
+        f.write("Package: %s\n" % (name.split("_")[0],))
+        if maintainer:
+            f.write("Maintainer: %s\n" % (maintainer,))
+        if depends:
+            f.write("Depends: %s\n" % (depends,))
+    return pkgpath
+
+def run(args, env, cwd):
+    """Return (PATH entries exported, stderr) of a json run.
+    """
+    p = subprocess.run([SSMUSE, "json"]+args, env=env, cwd=cwd,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        return None, p.stderr.decode()
+    paths = []
+    for op in json.loads(p.stdout.decode()):
+        if op["op"] == "exportpath" and op["name"] == "PATH":
+            paths.append(op["fallback"])
+    return paths, p.stderr.decode()
+
+def check_unresolvable(root):
+    """An unresolvable dependency is not loaded as a path relative to
+    the current directory, and is reported.
+    """
+    base = joinpath(root, "base")
+    pkgpath = mkpkg(base, "foo_1.0_test-x", "missing_9")
+    cwd = joinpath(root, "cwd")
+    os.makedirs(joinpath(cwd, "missing_9", "bin"))
+    env = {"PATH": "/usr/bin:/bin", "SSMUSE_PLATFORMS": "test-x", "SSMUSE_VERBOSE": "1"}
+    paths, err = run(["-p", pkgpath], env, cwd)
+    ok = paths == [joinpath(pkgpath, "bin")] \
+        and "cannot resolve dependency (missing_9)" in err
+    return ok, "paths (%s) stderr (%s)" % (paths, err)
+
+def check_cachedgraph(root):
+    """A cached graph is not used once a newer dependency is
+    installed.
+    """
+    base = joinpath(root, "base")
+    foopath = mkpkg(base, "foo_1.0_test-x", "bar")
+    mkpkg(base, "bar_1.0_test-x")
+    cachedir = joinpath(root, "cache")
+    os.makedirs(cachedir)
+    env = {"PATH": "/usr/bin:/bin", "SSMUSE_PLATFORMS": "test-x",
+        "SSMUSE_BASE": base, "SSMUSE_CACHE": cachedir}
+    paths1, err1 = run(["-p", "foo"], env, root)
+    barpath = mkpkg(base, "bar_2.0_test-x")
+    paths2, err2 = run(["-p", "foo"], env, root)
+    ok = paths1 == [joinpath(base, "bar_1.0_test-x/bin"), joinpath(foopath, "bin")] \
+        and paths2 == [joinpath(barpath, "bin"), joinpath(foopath, "bin")]
+    return ok, "before (%s) after (%s) stderr (%s%s)" % (paths1, paths2, err1, err2)
+
+def check_cachedgraphdeps(root):
+    """A cached graph is not used once a dependency resolved outside
+    of the package directory and base directories changes: newer
+    package installed there, or control file of a dependency edited.
+    """
+    base = joinpath(root, "base")
+    dirb = joinpath(root, "dirb")
+    foopath = mkpkg(base, "foo_1.0_test-x", joinpath(dirb, "bar"))
+    mkpkg(dirb, "bar_1.0_test-x")
+    cachedir = joinpath(root, "cache")
+    os.makedirs(cachedir)
+    env = {"PATH": "/usr/bin:/bin", "SSMUSE_PLATFORMS": "test-x",
+        "SSMUSE_BASE": base, "SSMUSE_CACHE": cachedir}
+    paths1, err1 = run(["-p", "foo"], env, root)
+    barpath = mkpkg(dirb, "bar_2.0_test-x")
+    paths2, err2 = run(["-p", "foo"], env, root)
+    bazpath = mkpkg(dirb, "baz_1.0_test-x")
+    with open(joinpath(barpath, ".ssm.d/control"), "a") as f:
+        f.write("Depends: baz\n")
+    paths3, err3 = run(["-p", "foo"], env, root)
+    ok = paths1 == [joinpath(dirb, "bar_1.0_test-x/bin"), joinpath(foopath, "bin")] \
+        and paths2 == [joinpath(barpath, "bin"), joinpath(foopath, "bin")] \
+        and paths3 == [joinpath(bazpath, "bin"), joinpath(barpath, "bin"), joinpath(foopath, "bin")]
+    return ok, "paths (%s) (%s) (%s) stderr (%s%s%s)" % (paths1, paths2, paths3, err1, err2, err3)
+
+def check_nonutf8control(root):
+    """Depends is read from a control file which is not UTF-8.
+    """
+    base = joinpath(root, "base")
+    foopath = mkpkg(base, "foo_1.0_test-x", "bar", maintainer="R\xe9mi")
+    barpath = mkpkg(base, "bar_1.0_test-x")
+    env = {"PATH": "/usr/bin:/bin", "SSMUSE_PLATFORMS": "test-x",
+        "SSMUSE_BASE": base, "SSMUSE_PROBE_TIMEOUT": "1"}
+    paths, err = run(["-p", "foo"], env, root)
+    ok = paths == [joinpath(barpath, "bin"), joinpath(foopath, "bin")] and not err
+    return ok, "paths (%s) stderr (%s)" % (paths, err)
+
+def main():
+    nfailed = 0
+    for fn in [check_unresolvable, check_cachedgraph, check_cachedgraphdeps,
+        check_nonutf8control]:
+        root = tempfile.mkdtemp(prefix="ssmuse-test")
+        try:
+            ok, details = fn(root)
+        finally:
+            shutil.rmtree(root)
+        print("%s %s" % (ok and "OK  " or "FAIL", fn.__name__))
+        if not ok:
+            print("    %s" % (details,))
+            nfailed += 1
+    if nfailed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#! /usr/bin/python3
+#
+# test_unload.py
+#
+# Checks of --unload and --swap, run through ssmuse-sh in bash (with
+# the awk ssmuse_cleanpath). Exits non-zero on failure.
+# (check_* rather than test_*: not pytest tests.)
+
+import os
+from os.path import dirname
+from os.path import join as joinpath
+import shutil
+import subprocess
+import sys
+import tempfile
+
+STATICDIR = joinpath(dirname(dirname(os.path.realpath(__file__))), "static")
+
+def mkdomain(root, name):
+    dompath = joinpath(root, name)
+    os.makedirs(joinpath(dompath, "etc/ssm.d"))
+    os.makedirs(joinpath(dompath, "test-x/bin"))
+    open(joinpath(dompath, "test-x/bin", "cmd"), "w").close()
+    return dompath
+
+def mkpkg(root, name):
+    pkgpath = joinpath(root, name)
+    os.makedirs(joinpath(pkgpath, ".ssm.d"))
+    os.makedirs(joinpath(pkgpath, "bin"))
+    open(joinpath(pkgpath, "bin", "cmd"), "w").close()
+    with open(joinpath(pkgpath, ".ssm.d/control"), "w") as f:
+        f.write("Package: %s\n" % (name.split("_")[0],))
+    return pkgpath
+
+def mkbin(root):
+    """Return bin directory with the front-end, __ssmuse, and an
+    ssmuse_cleanpath which runs the awk code.
+    """
+    bindir = joinpath(root, "bin")
+    os.makedirs(bindir)
+    for name in ["__ssmuse", "ssmuse-sh"]:
+        os.symlink(joinpath(STATICDIR, "bin", name), joinpath(bindir, name))
+    path = joinpath(bindir, "ssmuse_cleanpath")
+    with open(path, "w") as f:
+        f.write("#! /bin/sh\nexec sh %s \"$@\"\n" % (joinpath(STATICDIR, "lib/ssmuse/ssmuse_cleanpath.ksh"),))
+    os.chmod(path, 0o755)
+    return bindir
+
+def run(root, script):
+    """Return PATH entries under root after running script (lines of
+    ssmuse-sh arguments) in bash, and stderr.
+    """
+    bindir = joinpath(root, "bin")
+    env = {"PATH": "%s:/usr/bin:/bin" % (bindir,), "SSMUSE_PLATFORMS": "test-x",
+        "SSMUSE_BASE": root}
+    lines = [". ssmuse-sh %s" % (line,) for line in script]
+    lines.append('echo "${PATH}"')
+    p = subprocess.run(["bash", "-c", "\n".join(lines)], env=env, cwd=root,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    paths = [path for path in p.stdout.decode().strip().split(":")
+        if path.startswith(root+"/") and path != bindir]
+    return paths, p.stderr.decode()
+
+def check_unload(root):
+    """Only the entries of the unloaded domain are removed.
+    """
+    mkbin(root)
+    mkdomain(root, "dom")
+    pkgpath = mkpkg(root, "foo_1.0_test-x")
+    paths, err = run(root, ["-d dom -p foo", "--unload dom"])
+    ok = paths == [joinpath(pkgpath, "bin")] and not err
+    return ok, "paths (%s) stderr (%s)" % (paths, err)
+
+def check_unloadpkgname(root):
+    """A package is unloaded by name.
+    """
+    mkbin(root)
+    dompath = mkdomain(root, "dom")
+    mkpkg(root, "foo_1.0_test-x")
+    paths, err = run(root, ["-p foo -d dom", "--unload foo"])
+    ok = paths == [joinpath(dompath, "test-x/bin")] and not err
+    return ok, "paths (%s) stderr (%s)" % (paths, err)
+
+def check_swap(root):
+    """The new domain takes the position of the old one.
+    """
+    mkbin(root)
+    dom1path = mkdomain(root, "dom1")
+    dom2path = mkdomain(root, "dom2")
+    dom3path = mkdomain(root, "dom3")
+    paths, err = run(root, ["-d dom1 -d dom2", "--swap dom1 dom3"])
+    ok = paths == [joinpath(dom2path, "test-x/bin"), joinpath(dom3path, "test-x/bin")] \
+        and not err
+    return ok, "paths (%s) stderr (%s)" % (paths, err)
+
+def check_swapunloaded(root):
+    """Swapping out what is not loaded fails and changes nothing.
+    """
+    mkbin(root)
+    dom1path = mkdomain(root, "dom1")
+    mkdomain(root, "dom2")
+    paths, err = run(root, ["-d dom1", "--swap dom2 dom1"])
+    ok = paths == [joinpath(dom1path, "test-x/bin")] and err
+    return ok, "paths (%s) stderr (%s)" % (paths, err)
+
+def main():
+    nfailed = 0
+    for fn in [check_unload, check_unloadpkgname, check_swap, check_swapunloaded]:
+        root = os.path.realpath(tempfile.mkdtemp(prefix="ssmuse-test"))
+        try:
+            ok, details = fn(root)
+        finally:
+            shutil.rmtree(root)
+        print("%s %s" % (ok and "OK  " or "FAIL", fn.__name__))
+        if not ok:
+            print("    %s" % (details,))
+            nfailed += 1
+    if nfailed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()